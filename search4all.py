@@ -1,17 +1,21 @@
 import concurrent.futures
+import functools
+import hashlib
+import io
+import itertools
 import json
+import orjson
 import os
 import re
-import requests
-import traceback
+import threading
+import time
 import httpx
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Callable, NamedTuple
 from openai import AsyncOpenAI
 import asyncio
 from anthropic import AsyncAnthropic
 from loguru import logger
 from dotenv import load_dotenv
-import urllib.parse
 import trafilatura
 from trafilatura import bare_extraction
 import tldextract
@@ -22,8 +26,9 @@ load_dotenv()
 import sanic
 from sanic import Sanic
 import sanic.exceptions
-from sanic.exceptions import HTTPException, InvalidUsage
+from sanic.exceptions import HTTPException, InvalidUsage, PayloadTooLarge
 from sqlitedict import SqliteDict
+from cachetools import TTLCache
 
 app = Sanic("search")
 
@@ -48,13 +53,53 @@ SEARCH1API_SEARCH_ENDPOINT = "https://api.search1api.com/search/"
 # 8 is usually a good number.
 REFERENCE_COUNT = 8
 
+# Serper and SearchApi return results in pages of 10, so ask for
+# REFERENCE_COUNT rounded up to a multiple of 10.
+_SEARCH_NUM = (
+    REFERENCE_COUNT
+    if REFERENCE_COUNT % 10 == 0
+    else (REFERENCE_COUNT // 10 + 1) * 10
+)
+
 # Specify the default timeout for the search engine. If the search engine
 # does not respond within this time, we will return an error.
 DEFAULT_SEARCH_ENGINE_TIMEOUT = 5
 
+# SearXNG only returns short snippets, so we fetch the result pages and extract
+# their content. This caps how many pages are fetched at the same time, across
+# all requests, and how much of each page goes into the prompt.
+SEARXNG_EXTRACT_CONCURRENCY = 10
+SEARXNG_SNIPPET_LENGTH = 2000
+# The extracted content of a page is cached by URL for URL_CACHE_TTL seconds,
+# since the same pages tend to show up again for other queries.
+URL_CACHE_TTL = 3600
+URL_CACHE_SIZE = 4096
+
 # 默认记录的对话历史长度
 MAX_HISTORY_LEN = 10
 
+# Requests with a longer query (in UTF-8 bytes) are rejected before any search
+# or KV work.
+MAX_QUERY_LEN = 4096
+
+# Search engine results are cached by query, so the same question does not
+# hit the search engine again within SEARCH_CACHE_TTL seconds. The most recent
+# SEARCH_CACHE_SIZE entries are also kept in memory.
+SEARCH_CACHE_TTL = 3600
+SEARCH_CACHE_SIZE = 1024
+
+# Recently read or written KV values (results and chat histories, by
+# search_uuid) are kept in memory, so reloading a shared link doesn't read
+# the KV again. Only with a single worker: the workers share the KV file,
+# and each one's copy would miss the writes of the others.
+KV_CACHE_TTL = 60
+KV_CACHE_SIZE = 1024
+
+# KV writes are not committed one by one. They are committed every
+# KV_COMMIT_INTERVAL seconds, or as soon as KV_COMMIT_BATCH writes are pending.
+KV_COMMIT_INTERVAL = 0.5
+KV_COMMIT_BATCH = 100
+
 
 # If the user did not provide a query, we will use this default query.
 _default_query = "Who said 'live long and prosper'?"
@@ -76,6 +121,8 @@ Here are the set of contexts:
 
 Remember, don't blindly repeat the contexts verbatim. And here is the user question:
 """
+_RAG_FORMAT = _rag_query_text.format
+_CITATION_FORMAT = "[[citation:{}]] {}".format
 
 # A set of stop words to use - this is not a complete set, and you may want to
 # add more given your observation.
@@ -98,51 +145,223 @@ stop_words = [
 # consecutive requests to the model: one for the answer, and one for the related
 # questions. This is not ideal, but it is a good tradeoff between response time
 # and quality.
+_more_questions_prompt = r"""
+    You are a helpful assistant that helps the user to ask related questions, based on user's original question and the related contexts. Please identify worthwhile topics that can be follow-ups, and write questions no longer than 20 words each. Please make sure that specifics, like events, names, locations, are included in follow up questions so they can be asked standalone. For example, if the original question asks about "the Manhattan project", in the follow up question, do not just say "the project", but use the full name "the Manhattan project". Your related questions must be in the same language as the original question.
+
+    Here are the contexts of the question:
+
+    {context}
+
+    Remember, based on the original question and related contexts, suggest three such further questions. Do NOT repeat the original question. Each related question should be no longer than 20 words. Here is the original question:
+    """
 
 
 class KVWrapper(object):
-    def __init__(self, kv_name):
-        self._db = SqliteDict(filename=kv_name)
+    def __init__(self, kv_name, executor=None, use_cache=True):
+        # SqliteDict 是同步的，异步接口在这个线程池中执行读写
+        self._executor = executor
+        self._db = SqliteDict(
+            filename=kv_name, autocommit=False, journal_mode="WAL", outer_stack=False
+        )
+        self._pending_writes = 0
+        self._pending_lock = threading.Lock()
+        # 搜索结果缓存放在单独的表中，不会和以 search_uuid 为 key 的数据冲突。
+        # 两个 SqliteDict 各自持有未提交的写事务，同一个文件会互相锁住，
+        # 因此放在旁边单独的文件里
+        root, ext = os.path.splitext(kv_name)
+        self._search_db = SqliteDict(
+            filename=f"{root}-search-cache{ext or '.db'}",
+            tablename="search_cache",
+            autocommit=False,
+            journal_mode="WAL",
+            outer_stack=False,
+        )
+        self._search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+        self._search_cache_lock = threading.Lock()
+        self._cache = (
+            TTLCache(maxsize=KV_CACHE_SIZE, ttl=KV_CACHE_TTL) if use_cache else None
+        )
+        self._cache_lock = threading.Lock()
+
+    def _cache_get(self, key: str):
+        if self._cache is None:
+            return None
+        with self._cache_lock:
+            return self._cache.get(key)
+
+    def _cache_put(self, key: str, value):
+        if self._cache is None:
+            return
+        with self._cache_lock:
+            self._cache[key] = value
 
     def get(self, key: str):
+        v = self._cache_get(key)
+        if v is not None:
+            return v
         v = self._db[key]
         if v is None:
             raise KeyError(key)
+        self._cache_put(key, v)
         return v
 
+    def mget(self, keys):
+        """ 一次查询读取多个 key，不存在的 key 返回 None """
+        db = self._db
+        select = 'SELECT key, value FROM "%s" WHERE key IN (%s)' % (
+            db.tablename, ",".join("?" * len(keys))
+        )
+        found = {
+            db.decode_key(k): db.decode(v)
+            for k, v in db.conn.select(select, tuple(db.encode_key(k) for k in keys))
+        }
+        for key, v in found.items():
+            if v is not None:
+                self._cache_put(key, v)
+        return [found.get(key) for key in keys]
+
     def put(self, key: str, value: str):
         self._db[key] = value
-        self._db.commit()
-    
+        self._cache_put(key, value)
+        self._mark_dirty()
+
     def append(self, key: str, value):
         """ 记录聊天历史 """
-        self._db[key] = self._db.get(key, [])
-        # 最长记录的对话轮数 MAX_HISTORY_LEN
-        _ = self._db[key][-MAX_HISTORY_LEN:]
-        _.append(value)
-        self._db[key] = _
-        self._db.commit()
-
-# 格式化输出部分
-def extract_all_sections(text: str):
-    # 定义正则表达式模式以匹配各部分
-    sections_pattern = r"(.*?)__LLM_RESPONSE__(.*?)(__RELATED_QUESTIONS__(.*))?$"
-    
-    # 使用正则表达式查找各部分内容
-    match = re.search(sections_pattern, text, re.DOTALL)
-    
-    # 从匹配结果中提取文本，如果没有匹配则返回None
-    if match:
-        search_results = match.group(1).strip()  # 前置文本作为搜索结果
-        llm_response = match.group(2).strip()    # 问题回答部分
-        related_questions = match.group(4).strip() if match.group(4) else ""  # 相关问题文本，如果不存在则返回空字符串
-    else:
-        search_results, llm_response, related_questions = None, None, None
-    
-    return search_results, llm_response, related_questions
+        self._append(key, value)
+        self._mark_dirty()
+
+    def _append(self, key: str, value):
+        # 最长记录的对话轮数 MAX_HISTORY_LEN，追加前先截断
+        history = self._db.get(key, [])[-(MAX_HISTORY_LEN - 1):]
+        history.append(value)
+        self._db[key] = history
+        self._cache_put(key, history)
+
+    def put_and_append(self, key: str, value, history_key: str, history_entry):
+        """ 同时记录聊天历史和结果，只排入一次写入 """
+        self._append(history_key, history_entry)
+        self._db[key] = value
+        self._cache_put(key, value)
+        self._mark_dirty()
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def aget(self, key: str):
+        # 命中内存缓存时不需要切换到线程池
+        v = self._cache_get(key)
+        if v is not None:
+            return v
+        return await self._run(self.get, key)
+
+    async def amget(self, keys):
+        values = [self._cache_get(key) for key in keys]
+        if all(v is not None for v in values):
+            return values
+        return await self._run(self.mget, keys)
+
+    async def aput(self, key: str, value):
+        await self._run(self.put, key, value)
+
+    async def aappend(self, key: str, value):
+        await self._run(self.append, key, value)
+
+    async def aput_and_append(self, key: str, value, history_key: str, history_entry):
+        await self._run(self.put_and_append, key, value, history_key, history_entry)
+
+    def _mark_dirty(self):
+        with self._pending_lock:
+            self._pending_writes += 1
+            should_commit = self._pending_writes >= KV_COMMIT_BATCH
+        if should_commit:
+            self.commit()
+
+    def commit(self):
+        """ 提交尚未提交的写入，只是排入 SqliteDict 的队列，不会阻塞 """
+        with self._pending_lock:
+            if not self._pending_writes:
+                return
+            self._pending_writes = 0
+        self._db.commit(blocking=False)
+        self._search_db.commit(blocking=False)
+
+    def close(self):
+        # 关闭前阻塞提交所有未提交的写入
+        self._db.commit(blocking=True)
+        self._db.close()
+        self._search_db.commit(blocking=True)
+        self._search_db.close()
+
+    @staticmethod
+    def _search_cache_key(backend: str, query: str):
+        return hashlib.blake2b(f"{backend}:{query}".encode(), digest_size=16).hexdigest()
+
+    def search_cache_get(self, backend: str, query: str):
+        """ 读取缓存的搜索结果，不存在或已过期时返回 None """
+        key = self._search_cache_key(backend, query)
+        # 内存中也保存写入时间，过期时间以写入时间为准，而不是读入内存的时间
+        with self._search_cache_lock:
+            entry = self._search_cache.get(key)
+        if entry is None:
+            entry = self._search_db.get(key)
+            if entry is None:
+                return None
+            with self._search_cache_lock:
+                self._search_cache[key] = entry
+        timestamp, contexts = entry
+        if time.time() - timestamp > SEARCH_CACHE_TTL:
+            return None
+        return contexts
+
+    def search_cache_put(self, backend: str, query: str, contexts):
+        """ 缓存搜索结果 """
+        key = self._search_cache_key(backend, query)
+        entry = (time.time(), contexts)
+        with self._search_cache_lock:
+            self._search_cache[key] = entry
+        self._search_db[key] = entry
+        self._mark_dirty()
+
+    def purge_search_cache(self):
+        """ 删除过期的搜索结果缓存，避免数据库无限增长 """
+        now = time.time()
+        expired = [
+            key
+            for key, (timestamp, _) in self._search_db.iteritems()
+            if now - timestamp > SEARCH_CACHE_TTL
+        ]
+        for key in expired:
+            del self._search_db[key]
+        if expired:
+            self._mark_dirty()
+        return len(expired)
 
-def search_with_search1api(query: str, search1api_key: str):
-    """Search with bing and return the contexts."""
+    async def asearch_cache_get(self, backend: str, query: str):
+        return await self._run(self.search_cache_get, backend, query)
+
+    async def asearch_cache_put(self, backend: str, query: str, contexts):
+        await self._run(self.search_cache_put, backend, query, contexts)
+
+    async def apurge_search_cache(self):
+        return await self._run(self.purge_search_cache)
+
+
+class SearchBackend(NamedTuple):
+    """
+    How to query a search engine API and convert its response to contexts.
+    """
+    method: str
+    endpoint: str
+    # Environment variables holding the credentials, passed to request().
+    credentials: tuple
+    # Builds the httpx request arguments from the query and the credentials.
+    request: Callable[..., dict]
+    # Converts the json response to a list of {name, url, snippet} contexts.
+    parse: Callable[[dict], list]
+    timeout: object = DEFAULT_SEARCH_ENGINE_TIMEOUT
+
+
+def _search1api_request(query: str, search1api_key: str):
     payload = {
         "max_results": 10,
         "query": query,
@@ -152,257 +371,289 @@ def search_with_search1api(query: str, search1api_key: str):
         "Authorization": f"Bearer {search1api_key}",
         "Content-Type": "application/json"
     }
-    response = requests.request("POST", SEARCH1API_SEARCH_ENDPOINT, json=payload, headers=headers)
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
-    
-    json_content = response.json()
-    try:
-        contexts = json_content["results"][:REFERENCE_COUNT]
-        for item in contexts:
-            item["name"] = item["title"]
-            item["url"] = item["link"]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
-    
+    return {"headers": headers, "content": orjson.dumps(payload)}
+
+
+def _parse_search1api(json_content):
+    contexts = json_content["results"][:REFERENCE_COUNT]
+    for item in contexts:
+        item["name"] = item["title"]
+        item["url"] = item["link"]
     return contexts
-def search_with_bing(query: str, subscription_key: str):
-    """
-    Search with bing and return the contexts.
-    """
+
+
+def _bing_request(query: str, subscription_key: str):
     params = {"q": query, "mkt": BING_MKT}
-    response = requests.get(
-        BING_SEARCH_V7_ENDPOINT,
-        headers={"Ocp-Apim-Subscription-Key": subscription_key},
-        params=params,
-        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
-    json_content = response.json()
-    try:
-        contexts = json_content["webPages"]["value"][:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
-    return contexts
+    return {"headers": {"Ocp-Apim-Subscription-Key": subscription_key}, "params": params}
 
 
-def search_with_google(query: str, subscription_key: str, cx: str):
-    """
-    Search with google and return the contexts.
-    """
+def _parse_bing(json_content):
+    return json_content["webPages"]["value"]
+
+
+def _google_request(query: str, subscription_key: str, cx: str):
     params = {
         "key": subscription_key,
         "cx": cx,
         "q": query,
         "num": REFERENCE_COUNT,
     }
-    response = requests.get(
-        GOOGLE_SEARCH_ENDPOINT, params=params, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
-    json_content = response.json()
-    try:
-        contexts = json_content["items"][:REFERENCE_COUNT]
-        for item in contexts:
-            item["name"] = item["title"]
-            item["url"] = item["link"]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
+    return {"params": params}
+
+
+def _parse_google(json_content):
+    contexts = json_content["items"][:REFERENCE_COUNT]
+    for item in contexts:
+        item["name"] = item["title"]
+        item["url"] = item["link"]
     return contexts
 
 
-def search_with_serper(query: str, subscription_key: str):
-    """
-    Search with serper and return the contexts.
-    """
-    payload = json.dumps(
-        {
-            "q": query,
-            "num": (
-                REFERENCE_COUNT
-                if REFERENCE_COUNT % 10 == 0
-                else (REFERENCE_COUNT // 10 + 1) * 10
-            ),
-        }
-    )
+def _serper_request(query: str, subscription_key: str):
     headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
-    logger.info(
-        f"{payload} {headers} {subscription_key} {query} {SERPER_SEARCH_ENDPOINT}"
-    )
-    response = requests.post(
-        SERPER_SEARCH_ENDPOINT,
-        headers=headers,
-        data=payload,
-        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
-    json_content = response.json()
-    try:
-        # convert to the same format as bing/google
-        contexts = []
-        if json_content.get("knowledgeGraph"):
-            url = json_content["knowledgeGraph"].get("descriptionUrl") or json_content[
-                "knowledgeGraph"
-            ].get("website")
-            snippet = json_content["knowledgeGraph"].get("description")
-            if url and snippet:
-                contexts.append(
-                    {
-                        "name": json_content["knowledgeGraph"].get("title", ""),
-                        "url": url,
-                        "snippet": snippet,
-                    }
-                )
-        if json_content.get("answerBox"):
-            url = json_content["answerBox"].get("url")
-            snippet = json_content["answerBox"].get("snippet") or json_content[
-                "answerBox"
-            ].get("answer")
-            if url and snippet:
-                contexts.append(
-                    {
-                        "name": json_content["answerBox"].get("title", ""),
-                        "url": url,
-                        "snippet": snippet,
-                    }
-                )
-        contexts += [
-            {"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")}
-            for c in json_content["organic"]
-        ]
-        return contexts[:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error encountered: {json_content}")
-        return []
+    return {"headers": headers, "content": orjson.dumps({"q": query, "num": _SEARCH_NUM})}
+
+
+def _parse_serper(json_content):
+    # convert to the same format as bing/google
+    contexts = []
+    if json_content.get("knowledgeGraph"):
+        url = json_content["knowledgeGraph"].get("descriptionUrl") or json_content[
+            "knowledgeGraph"
+        ].get("website")
+        snippet = json_content["knowledgeGraph"].get("description")
+        if url and snippet:
+            contexts.append(
+                {
+                    "name": json_content["knowledgeGraph"].get("title", ""),
+                    "url": url,
+                    "snippet": snippet,
+                }
+            )
+    if json_content.get("answerBox"):
+        url = json_content["answerBox"].get("url")
+        snippet = json_content["answerBox"].get("snippet") or json_content[
+            "answerBox"
+        ].get("answer")
+        if url and snippet:
+            contexts.append(
+                {
+                    "name": json_content["answerBox"].get("title", ""),
+                    "url": url,
+                    "snippet": snippet,
+                }
+            )
+    contexts += [
+        {"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")}
+        for c in json_content["organic"]
+    ]
+    return contexts
 
 
-def search_with_searchapi(query: str, subscription_key: str):
-    """
-    Search with SearchApi.io and return the contexts.
-    """
-    payload = {
+def _searchapi_request(query: str, subscription_key: str):
+    params = {
         "q": query,
         "engine": "google",
-        "num": (
-            REFERENCE_COUNT
-            if REFERENCE_COUNT % 10 == 0
-            else (REFERENCE_COUNT // 10 + 1) * 10
-        ),
+        "num": _SEARCH_NUM,
     }
     headers = {
         "Authorization": f"Bearer {subscription_key}",
         "Content-Type": "application/json",
     }
-    logger.info(
-        f"{payload} {headers} {subscription_key} {query} {SEARCHAPI_SEARCH_ENDPOINT}"
-    )
-    response = requests.get(
-        SEARCHAPI_SEARCH_ENDPOINT,
-        headers=headers,
-        params=payload,
-        timeout=30,
-    )
-    if not response.ok:
-        logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
-    json_content = response.json()
-    try:
-        # convert to the same format as bing/google
-        contexts = []
+    return {"headers": headers, "params": params}
 
-        if json_content.get("answer_box"):
-            if json_content["answer_box"].get("organic_result"):
-                title = (
-                    json_content["answer_box"].get("organic_result").get("title", "")
-                )
-                url = json_content["answer_box"].get("organic_result").get("link", "")
-            if json_content["answer_box"].get("type") == "population_graph":
-                title = json_content["answer_box"].get("place", "")
-                url = json_content["answer_box"].get("explore_more_link", "")
 
-            title = json_content["answer_box"].get("title", "")
-            url = json_content["answer_box"].get("link")
-            snippet = json_content["answer_box"].get("answer") or json_content[
-                "answer_box"
-            ].get("snippet")
+def _parse_searchapi(json_content):
+    # convert to the same format as bing/google
+    contexts = []
 
-            if url and snippet:
-                contexts.append({"name": title, "url": url, "snippet": snippet})
+    if json_content.get("answer_box"):
+        if json_content["answer_box"].get("organic_result"):
+            title = (
+                json_content["answer_box"].get("organic_result").get("title", "")
+            )
+            url = json_content["answer_box"].get("organic_result").get("link", "")
+        if json_content["answer_box"].get("type") == "population_graph":
+            title = json_content["answer_box"].get("place", "")
+            url = json_content["answer_box"].get("explore_more_link", "")
+
+        title = json_content["answer_box"].get("title", "")
+        url = json_content["answer_box"].get("link")
+        snippet = json_content["answer_box"].get("answer") or json_content[
+            "answer_box"
+        ].get("snippet")
+
+        if url and snippet:
+            contexts.append({"name": title, "url": url, "snippet": snippet})
 
-        if json_content.get("knowledge_graph"):
-            if json_content["knowledge_graph"].get("source"):
-                url = json_content["knowledge_graph"].get("source").get("link", "")
+    if json_content.get("knowledge_graph"):
+        if json_content["knowledge_graph"].get("source"):
+            url = json_content["knowledge_graph"].get("source").get("link", "")
 
-            url = json_content["knowledge_graph"].get("website", "")
-            snippet = json_content["knowledge_graph"].get("description")
+        url = json_content["knowledge_graph"].get("website", "")
+        snippet = json_content["knowledge_graph"].get("description")
+
+        if url and snippet:
+            contexts.append(
+                {
+                    "name": json_content["knowledge_graph"].get("title", ""),
+                    "url": url,
+                    "snippet": snippet,
+                }
+            )
+
+    contexts += [
+        {"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")}
+        for c in json_content["organic_results"]
+    ]
+
+    if json_content.get("related_questions"):
+        for question in json_content["related_questions"]:
+            if question.get("source"):
+                url = question.get("source").get("link", "")
+            else:
+                url = ""
+
+            snippet = question.get("answer", "")
 
             if url and snippet:
                 contexts.append(
                     {
-                        "name": json_content["knowledge_graph"].get("title", ""),
+                        "name": question.get("question", ""),
                         "url": url,
                         "snippet": snippet,
                     }
                 )
 
-        contexts += [
-            {"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")}
-            for c in json_content["organic_results"]
-        ]
-
-        if json_content.get("related_questions"):
-            for question in json_content["related_questions"]:
-                if question.get("source"):
-                    url = question.get("source").get("link", "")
-                else:
-                    url = ""
-
-                snippet = question.get("answer", "")
+    return contexts
 
-                if url and snippet:
-                    contexts.append(
-                        {
-                            "name": question.get("question", ""),
-                            "url": url,
-                            "snippet": snippet,
-                        }
-                    )
 
-        return contexts[:REFERENCE_COUNT]
+# The search engine APIs, by the name used in the BACKEND environment variable.
+# SearXNG also extracts the content of the result pages, so it is handled by
+# search_with_searXNG instead.
+SEARCH_BACKENDS = {
+    "BING": SearchBackend(
+        "GET",
+        BING_SEARCH_V7_ENDPOINT,
+        ("BING_SEARCH_V7_SUBSCRIPTION_KEY",),
+        _bing_request,
+        _parse_bing,
+    ),
+    "GOOGLE": SearchBackend(
+        "GET",
+        GOOGLE_SEARCH_ENDPOINT,
+        ("GOOGLE_SEARCH_API_KEY", "GOOGLE_SEARCH_CX"),
+        _google_request,
+        _parse_google,
+    ),
+    "SERPER": SearchBackend(
+        "POST",
+        SERPER_SEARCH_ENDPOINT,
+        ("SERPER_SEARCH_API_KEY",),
+        _serper_request,
+        _parse_serper,
+    ),
+    "SEARCHAPI": SearchBackend(
+        "GET",
+        SEARCHAPI_SEARCH_ENDPOINT,
+        ("SEARCHAPI_API_KEY",),
+        _searchapi_request,
+        _parse_searchapi,
+        timeout=30,
+    ),
+    "SEARCH1API": SearchBackend(
+        "POST",
+        SEARCH1API_SEARCH_ENDPOINT,
+        ("SEARCH1API_KEY",),
+        _search1api_request,
+        _parse_search1api,
+        timeout=httpx.USE_CLIENT_DEFAULT,
+    ),
+}
+
+
+async def search_with_backend(
+    backend: SearchBackend, query: str, credentials, client: httpx.AsyncClient
+):
+    """
+    Search with one of SEARCH_BACKENDS and return the contexts.
+    """
+    response = await client.request(
+        backend.method,
+        backend.endpoint,
+        timeout=backend.timeout,
+        **backend.request(query, *credentials),
+    )
+    if not response.is_success:
+        logger.error(f"{response.status_code} {response.text}")
+        raise HTTPException("Search engine error.")
+    json_content = orjson.loads(response.content)
+    try:
+        return backend.parse(json_content)[:REFERENCE_COUNT]
     except KeyError:
         logger.error(f"Error encountered: {json_content}")
         return []
 
 
-def extract_url_content(url):
-    logger.info(url)
-    downloaded = trafilatura.fetch_url(url)
-    content =  trafilatura.extract(downloaded)
+def extract_content(html):
+    # 先只用 trafilatura 自己的提取器，跳过 readability/justext 兜底，速度快很多
+    content = trafilatura.extract(
+        html,
+        no_fallback=True,
+        favor_precision=True,
+        include_comments=False,
+        include_tables=False,
+    )
+    if content is None:
+        # 快速提取失败时再走完整的提取流程
+        content = trafilatura.extract(html)
+    return content
 
-    logger.info(url +"______"+  content)
-    return {"url":url, "content":content}
 
+# 只使用 tldextract 自带的 public suffix 列表，不在运行时下载
+_tld_extract = tldextract.TLDExtract(suffix_list_urls=())
 
 
-def search_with_searXNG(query:str,url:str):
+@functools.lru_cache(maxsize=1024)
+def get_site_name(netloc: str):
+    return _tld_extract(netloc).domain
+
+
+_url_content_cache = TTLCache(maxsize=URL_CACHE_SIZE, ttl=URL_CACHE_TTL)
+
+
+async def extract_url_content(url, client: httpx.AsyncClient, semaphore: asyncio.Semaphore):
+    key = hashlib.blake2b(url.encode(), digest_size=16).digest()
+    cached = _url_content_cache.get(key)
+    if cached is not None:
+        return cached
+    async with semaphore:
+        logger.info(url)
+        response = await client.get(url, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT, follow_redirects=True)
+        response.raise_for_status()
+        # trafilatura is CPU bound, keep it off the event loop.
+        content = await asyncio.to_thread(extract_content, response.text)
+    # 只用到正文的前 SEARXNG_SNIPPET_LENGTH 个字符，缓存前先截断
+    result = {"url":url, "content":content[:SEARXNG_SNIPPET_LENGTH] if content else content}
+    _url_content_cache[key] = result
+    return result
+
+
+
+async def search_with_searXNG(query:str,url:str,client:httpx.AsyncClient,semaphore:asyncio.Semaphore):
  
     content_list = []
 
     try:
-        safe_string = urllib.parse.quote_plus(":auto " + query)
-        response = requests.get(url+'?q=' + safe_string + '&category=general&format=json&engines=bing%2Cgoogle')
+        params = {
+            "q": ":auto " + query,
+            "category": "general",
+            "format": "json",
+            "engines": "bing,google",
+        }
+        response = await client.get(url, params=params)
         response.raise_for_status()
-        search_results = response.json()
+        search_results = orjson.loads(response.content)
 
         pedding_urls = []
 
@@ -413,13 +664,13 @@ def search_with_searXNG(query:str,url:str):
                 name = item.get('title')
                 snippet = item.get('content')
                 url = item.get('url')
+                if not url:
+                    continue
                 pedding_urls.append(url)
 
-                if url:
-                    url_parsed = urlparse(url)
-                    domain = url_parsed.netloc
-                    icon_url =  url_parsed.scheme + '://' + url_parsed.netloc + '/favicon.ico'
-                    site_name = tldextract.extract(url).domain
+                url_parsed = urlparse(url)
+                icon_url =  url_parsed.scheme + '://' + url_parsed.netloc + '/favicon.ico'
+                site_name = get_site_name(url_parsed.netloc)
 
                 conv_links.append({
                     'site_name':site_name,
@@ -429,34 +680,32 @@ def search_with_searXNG(query:str,url:str):
                     'url':url,
                     'snippet':snippet
                 })
-            results = []
-            futures = []
-
-            # executor = ThreadPoolExecutor(max_workers=10) 
-            # for url in pedding_urls:
-            #     futures.append(executor.submit(extract_url_content,url))
-            # try:
-            #     for future in futures:
-            #         res = future.result(timeout=5)
-            #         results.append(res)
-            # except concurrent.futures.TimeoutError:
-            #     logger.error("任务执行超时")
-            #     executor.shutdown(wait=False,cancel_futures=True)
-            # logger.info(results)
-            # for content in results:
-            #     if content and content.get('content'):
-                    
-            #         item_dict = {
-            #             "url":content.get('url'),
-            #             "name":content.get('url'),
-            #             "snippet":content.get('content'),
-            #             "content": content.get('content'),
-            #             "length":len(content.get('content'))
-            #         }
-            #         content_list.append(item_dict)
-            #     logger.info("URL: {}".format(url))
-            #     logger.info("=================")
-        if len(results)== 0 :
+
+            # 并发抓取所有结果页面的正文，单个页面超时或失败不影响其他页面
+            results = await asyncio.gather(
+                *[
+                    asyncio.wait_for(
+                        extract_url_content(pedding_url, client, semaphore),
+                        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
+                    )
+                    for pedding_url in pedding_urls
+                ],
+                return_exceptions=True,
+            )
+            for link, content in zip(conv_links, results):
+                if isinstance(content, asyncio.TimeoutError):
+                    logger.error(f"任务执行超时: {link['url']}")
+                    continue
+                if isinstance(content, Exception):
+                    logger.error(f"Failed to extract {link['url']}: {content}")
+                    continue
+                if content.get('content'):
+                    # extract_url_content 返回的已经是截断后的正文
+                    content_list.append({
+                        **link,
+                        "snippet": content['content'],
+                    })
+        if len(content_list)== 0 :
             content_list = conv_links
         return  content_list
     except Exception as ex:
@@ -464,18 +713,58 @@ def search_with_searXNG(query:str,url:str):
         raise ex
 
 
+# Query parameters that only track the click and don't change the page.
+_TRACKING_PARAMS = ("utm_", "gclid", "fbclid", "msclkid", "spm")
+
+
+def _dedup_key(url: str):
+    """
+    Normalizes a url so the same page found by different backends matches.
+    """
+    url_parsed = urlparse(url)
+    query = "&".join(
+        param
+        for param in url_parsed.query.split("&")
+        if param and not param.lower().startswith(_TRACKING_PARAMS)
+    )
+    netloc = url_parsed.netloc.lower().removeprefix("www.")
+    return f"{netloc}{url_parsed.path.rstrip('/')}?{query}"
+
+
+def _merge_dedup(results_list):
+    """
+    Interleaves the contexts of every backend, so each one contributes its
+    best results first, and drops the urls already seen.
+    """
+    merged = {}
+    for contexts in itertools.zip_longest(*results_list):
+        for c in contexts:
+            if c is None or not c.get("url"):
+                continue
+            merged.setdefault(_dedup_key(c["url"]), c)
+    return list(merged.values())
+
+
+async def search_with_backends(query: str, search_functions):
+    """
+    Searches with all the configured backends concurrently and merges the
+    contexts. Latency is that of the slowest backend, and a failing backend
+    is skipped as long as another one answers.
+    """
+    if len(search_functions) == 1:
+        return await search_functions[0](query)
+    results_list = await asyncio.gather(
+        *(f(query) for f in search_functions), return_exceptions=True
+    )
+    errors = [r for r in results_list if isinstance(r, BaseException)]
+    for e in errors:
+        logger.error(f"Search backend failed: {e}")
+    if len(errors) == len(results_list):
+        raise errors[0]
+    return _merge_dedup(
+        [r for r in results_list if not isinstance(r, BaseException)]
+    )[:REFERENCE_COUNT]
 
-def new_async_client(_app):
-    if "claude-3" in _app.ctx.model.lower():
-        return AsyncAnthropic(
-            api_key=os.getenv("ANTHROPIC_API_KEY")
-        )
-    else:
-        return AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY") or os.getenv("GROQ_API_KEY"),
-            base_url=os.getenv("OPENAI_BASE_URL"),
-            http_client=_app.ctx.http_session,
-        )
 
 @app.before_server_start
 async def server_init(_app):
@@ -492,54 +781,88 @@ async def server_init(_app):
     #         stream=True,
     #         timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
     #     )
-    if _app.ctx.backend == "BING":
-        _app.ctx.search_api_key = os.getenv("BING_SEARCH_V7_SUBSCRIPTION_KEY")
-        _app.ctx.search_function = lambda query: search_with_bing(
-            query,
-            _app.ctx.search_api_key,
-        )
-    elif _app.ctx.backend == "GOOGLE":
-        _app.ctx.search_api_key = os.getenv("GOOGLE_SEARCH_API_KEY")
-        _app.ctx.search_function = lambda query: search_with_google(
-            query,
-            _app.ctx.search_api_key,
-            os.getenv("GOOGLE_SEARCH_CX"),
-        )
-    elif _app.ctx.backend == "SERPER":
-        _app.ctx.search_api_key = os.getenv("SERPER_SEARCH_API_KEY")
-        _app.ctx.search_function = lambda query: search_with_serper(
-            query,
-            _app.ctx.search_api_key,
-        )
-    elif _app.ctx.backend == "SEARCHAPI":
-        _app.ctx.search_api_key = os.getenv("SEARCHAPI_API_KEY")
-        _app.ctx.search_function = lambda query: search_with_searchapi(
-            query,
-            _app.ctx.search_api_key,
-        )
-    elif _app.ctx.backend == "SEARCH1API":
-        _app.ctx.search1api_key = os.getenv("SEARCH1API_KEY")
-        _app.ctx.search_function = lambda query: search_with_search1api(
-            query,
-            _app.ctx.search1api_key,
-        )
-    elif _app.ctx.backend == "SEARXNG":
-        logger.info(os.getenv("SEARXNG_BASE_URL"))
-        _app.ctx.search_function = lambda query: search_with_searXNG(
-            query, 
-            os.getenv("SEARXNG_BASE_URL"),
+    # Create httpx Session. It is shared by the search engines and the LLM
+    # clients, HTTP/2 lets concurrent requests to the same host share one
+    # connection, and idle connections are kept alive across user queries.
+    _app.ctx.http_session = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=200, max_keepalive_connections=50, keepalive_expiry=60
+        ),
+        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+    )
+    # BACKEND may list several backends separated by commas, they are searched
+    # concurrently and their results merged.
+    search_functions = []
+    for backend_name in _app.ctx.backend.split(","):
+        backend_name = backend_name.strip()
+        if backend_name in SEARCH_BACKENDS:
+            backend = SEARCH_BACKENDS[backend_name]
+            search_functions.append(
+                functools.partial(
+                    search_with_backend,
+                    backend,
+                    credentials=[os.getenv(name) for name in backend.credentials],
+                    client=_app.ctx.http_session,
+                )
+            )
+        elif backend_name == "SEARXNG":
+            logger.info(os.getenv("SEARXNG_BASE_URL"))
+            search_functions.append(
+                functools.partial(
+                    search_with_searXNG,
+                    url=os.getenv("SEARXNG_BASE_URL"),
+                    client=_app.ctx.http_session,
+                    # 所有请求共用，限制同时抓取的页面数
+                    semaphore=asyncio.Semaphore(SEARXNG_EXTRACT_CONCURRENCY),
+                )
+            )
+        else:
+            raise RuntimeError(
+                "Backend must be BING, GOOGLE, SERPER, SEARCHAPI, SEARCH1API or SEARXNG."
+            )
+    _app.ctx.search_function = functools.partial(
+        search_with_backends, search_functions=search_functions
+    )
+    _app.ctx.model = os.getenv("LLM_MODEL")
+    # The LLM client is created once and sends its requests over the shared
+    # httpx session. The provider doesn't change after startup, so the
+    # functions that talk to it are picked here as well.
+    if "claude-3" in _app.ctx.model.lower():
+        _app.ctx.llm_client = AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            http_client=_app.ctx.http_session,
         )
+        _app.ctx.llm_stream_fn = _stream_claude
+        _app.ctx.related_questions_fn = _related_questions_claude
     else:
-        raise RuntimeError("Backend must be BING, GOOGLE, SERPER or SEARCHAPI or SEARCH1API.")
-    _app.ctx.model = os.getenv("LLM_MODEL")
+        _app.ctx.llm_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY") or os.getenv("GROQ_API_KEY"),
+            base_url=os.getenv("OPENAI_BASE_URL"),
+            http_client=_app.ctx.http_session,
+        )
+        _app.ctx.llm_stream_fn = _stream_openai
+        _app.ctx.related_questions_fn = _related_questions_openai
     _app.ctx.handler_max_concurrency = 16
-    # An executor to carry out async tasks, such as uploading to KV.
+    # An executor to carry out blocking tasks, such as reading from KV. It is
+    # also the loop's default executor, so asyncio.to_thread (page extraction,
+    # encoding large frames) shares the same pool.
     _app.ctx.executor = concurrent.futures.ThreadPoolExecutor(
-        max_workers=_app.ctx.handler_max_concurrency * 2
+        max_workers=int(
+            os.getenv("KV_EXECUTOR_THREADS") or _app.ctx.handler_max_concurrency * 2
+        ),
+        thread_name_prefix="kv",
     )
+    asyncio.get_running_loop().set_default_executor(_app.ctx.executor)
     # Create the KV to store the search results.
     logger.info("Creating KV. May take a while for the first time.")
-    _app.ctx.kv = KVWrapper(os.getenv("KV_NAME") or "search.db")
+    _app.ctx.kv = KVWrapper(
+        os.getenv("KV_NAME") or "search.db",
+        executor=_app.ctx.executor,
+        use_cache=int(os.getenv("WORKERS") or 1) <= 1,
+    )
+    # KV writes are queued and applied one at a time by kv_writer.
+    _app.ctx.kv_queue = asyncio.Queue()
     # whether we should generate related questions.
     _app.ctx.should_do_related_questions = bool(
         os.getenv("RELATED_QUESTIONS") in ("1", "yes", "true")
@@ -547,205 +870,451 @@ async def server_init(_app):
     _app.ctx.should_do_chat_history = bool(
         os.getenv("CHAT_HISTORY") in ("1", "yes", "true")
     )
-    # Create httpx Session
-    _app.ctx.http_session = httpx.AsyncClient(
-        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
-    )
+    _app.add_task(kv_writer(_app), name="kv_writer")
+    _app.add_task(kv_committer(_app), name="kv_committer")
+
 
-async def get_related_questions(_app, query, contexts):
+@app.after_server_stop
+async def server_shutdown(_app):
     """
-    Gets related questions based on the query and context.
+    Applies the queued KV writes and flushes the KV to disk.
     """
-    _more_questions_prompt = r"""
-    You are a helpful assistant that helps the user to ask related questions, based on user's original question and the related contexts. Please identify worthwhile topics that can be follow-ups, and write questions no longer than 20 words each. Please make sure that specifics, like events, names, locations, are included in follow up questions so they can be asked standalone. For example, if the original question asks about "the Manhattan project", in the follow up question, do not just say "the project", but use the full name "the Manhattan project". Your related questions must be in the same language as the original question.
+    # Sanic has already cancelled kv_writer and kv_committer by the time this
+    # runs, so the writes still queued are applied here.
+    await _app.cancel_task("kv_writer", raise_exception=False)
+    await _app.cancel_task("kv_committer", raise_exception=False)
+    queue = _app.ctx.kv_queue
+    while not queue.empty():
+        write, args = queue.get_nowait()
+        try:
+            await write(*args)
+        except Exception as e:
+            logger.error(f"KV error: {e}")
+        finally:
+            queue.task_done()
+    _app.ctx.kv.close()
 
-    Here are the contexts of the question:
 
-    {context}
+def submit_kv_write(_app, write, *args):
+    """
+    Queues a KV write without waiting for it.
+    """
+    _app.ctx.kv_queue.put_nowait((write, args))
 
-    Remember, based on the original question and related contexts, suggest three such further questions. Do NOT repeat the original question. Each related question should be no longer than 20 words. Here is the original question:
-    """.format(
-        context="\n\n".join([c["snippet"] for c in contexts])
-    )
 
-    try:
-        logger.info('Start getting related questions')
-        if "claude-3" in _app.ctx.model.lower():
-            logger.info('Using Claude-3 model')
-            client = new_async_client(_app)
-            tools = [
-                {
-                    "name": "ask_related_questions",
-                    "description": "Get a list of questions related to the original question and context.",
-                    "input_schema": {
-                        "type": "object",
-                        "properties": {
-                            "questions": {
-                                "type": "array",
-                                "items": {
-                                    "type": "string",
-                                    "description": "A related question to the original question and context.",
-                                }
-                            }
-                        },
-                        "required": ["questions"]
+async def kv_writer(_app):
+    """
+    Applies the queued KV writes in order. SqliteDict serializes every
+    operation on a single connection anyway, so one writer is enough, and it
+    also keeps read-modify-writes such as KVWrapper.append from racing.
+    """
+    while True:
+        write, args = await _app.ctx.kv_queue.get()
+        try:
+            await write(*args)
+        except Exception as e:
+            logger.error(f"KV error: {e}")
+        finally:
+            _app.ctx.kv_queue.task_done()
+
+
+async def kv_committer(_app):
+    """
+    Periodically commits the pending KV writes, and purges the expired search
+    cache entries every SEARCH_CACHE_TTL seconds.
+    """
+    last_purge = time.monotonic()
+    while True:
+        await asyncio.sleep(KV_COMMIT_INTERVAL)
+        _app.ctx.kv.commit()
+        if time.monotonic() - last_purge > SEARCH_CACHE_TTL:
+            last_purge = time.monotonic()
+            # 和其他写入一样由 kv_writer 执行
+            submit_kv_write(_app, _app.ctx.kv.apurge_search_cache)
+
+
+async def _related_questions_claude(_app, query, more_questions_prompt):
+    """
+    Asks Claude for the related questions with a tool call.
+    """
+    logger.info('Using Claude-3 model')
+    client = _app.ctx.llm_client
+    tools = [
+        {
+            "name": "ask_related_questions",
+            "description": "Get a list of questions related to the original question and context.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "questions": {
+                        "type": "array",
+                        "items": {
+                            "type": "string",
+                            "description": "A related question to the original question and context.",
+                        }
                     }
-                    
-                }
-            ]
-            response = await client.beta.tools.messages.create(
-                model=_app.ctx.model,
-                system=_more_questions_prompt,
-                max_tokens=1000,
-                tools=tools,  
-                messages=[
-                {"role": "user", "content": query},
-            ]
-            )
-            logger.info('Response received from Claude-3 model')
-
-            if response.content and len(response.content) > 0:
-                related = []
-                for block in response.content:
-                    if block.type == "tool_use" and block.name == "ask_related_questions":
-                        related = block.input["questions"]
-                        break
-            else:
-                related = []
+                },
+                "required": ["questions"]
+            }
             
-            if related and isinstance(related, str):
-                try:
-                    related = json.loads(related)
-                except json.JSONDecodeError:
-                    logger.error("Failed to parse related questions as JSON")
-                    return []
-            logger.info('Successfully got related questions')
-            return [{"question": question} for question in related[:5]] 
-        else:
-            logger.info('Using OpenAI model')
-            openai_client = new_async_client(_app)
-            tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "ask_related_questions",
-                        "description": "Get a list of questions related to the original question and context.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "questions": {
-                                    "type": "array",
-                                    "items": {
-                                        "type": "string",
-                                        "description": "A related question to the original question and context.",
-                                    }
-                                }
-                            },
-                            "required": ["questions"]
+        }
+    ]
+    response = await client.beta.tools.messages.create(
+        model=_app.ctx.model,
+        system=more_questions_prompt,
+        max_tokens=1000,
+        tools=tools,  
+        messages=build_messages(None, None, query),
+    )
+    logger.info('Response received from Claude-3 model')
+
+    if response.content and len(response.content) > 0:
+        related = []
+        for block in response.content:
+            if block.type == "tool_use" and block.name == "ask_related_questions":
+                related = block.input["questions"]
+                break
+    else:
+        related = []
+    
+    if related and isinstance(related, str):
+        try:
+            related = json.loads(related)
+        except json.JSONDecodeError:
+            logger.error("Failed to parse related questions as JSON")
+            return []
+    logger.info('Successfully got related questions')
+    return [{"question": question} for question in related[:5]]
+
+
+async def _related_questions_openai(_app, query, more_questions_prompt):
+    """
+    Asks an OpenAI compatible model for the related questions with a tool call.
+    """
+    logger.info('Using OpenAI model')
+    openai_client = _app.ctx.llm_client
+    tools = [
+        {
+            "type": "function",
+            "function": {
+                "name": "ask_related_questions",
+                "description": "Get a list of questions related to the original question and context.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "questions": {
+                            "type": "array",
+                            "items": {
+                                "type": "string",
+                                "description": "A related question to the original question and context.",
+                            }
                         }
-                    }
-                }
-            ]
-            messages=[
-                    {"role": "system", "content": _more_questions_prompt},
-                    {"role": "user", "content": query},
-                ]
-            request_body = {
-                "model": _app.ctx.model,
-                "messages": messages,
-                "max_tokens": 1000,
-                "tools": tools,
-                "tool_choice": {
-                "type": "function",
-                "function": {
-                    "name": "ask_related_questions"
+                    },
+                    "required": ["questions"]
                 }
-                },        
             }
-            try:
-                llm_response = await openai_client.chat.completions.create(**request_body)
+        }
+    ]
+    messages = build_messages(more_questions_prompt, None, query)
+    request_body = {
+        "model": _app.ctx.model,
+        "messages": messages,
+        "max_tokens": 1000,
+        "tools": tools,
+        "tool_choice": {
+        "type": "function",
+        "function": {
+            "name": "ask_related_questions"
+        }
+        },        
+    }
+    try:
+        llm_response = await openai_client.chat.completions.create(**request_body)
+        
+        if llm_response.choices and llm_response.choices[0].message:
+            message = llm_response.choices[0].message
+            
+            if message.tool_calls:
+                related = message.tool_calls[0].function.arguments
+                if isinstance(related, str):
+                    related = json.loads(related)
+                logger.trace(f"Related questions: {related}")
+                return [{"question": question} for question in related["questions"][:5]]
+            
+            elif message.content:
+                # 如果不存在 tool_calls 字段,但存在 content 字段,从 content 中提取相关问题
+                content = message.content
+                related_questions = content.split('\n')
+                related_questions = [q.strip() for q in related_questions if q.strip()]
                 
-                if llm_response.choices and llm_response.choices[0].message:
-                    message = llm_response.choices[0].message
-                    
-                    if message.tool_calls:
-                        related = message.tool_calls[0].function.arguments
-                        if isinstance(related, str):
-                            related = json.loads(related)
-                        logger.trace(f"Related questions: {related}")
-                        return [{"question": question} for question in related["questions"][:5]]
-                    
-                    elif message.content:
-                        # 如果不存在 tool_calls 字段,但存在 content 字段,从 content 中提取相关问题
-                        content = message.content
-                        related_questions = content.split('\n')
-                        related_questions = [q.strip() for q in related_questions if q.strip()]
+                # 提取带有序号的问题
+                cleaned_questions = []
+                for question in related_questions:
+                    if question.startswith('1.') or question.startswith('2.') or question.startswith('3.'):
+                        question = question[3:].strip()  # 去除问题编号和空格
                         
-                        # 提取带有序号的问题
-                        cleaned_questions = []
-                        for question in related_questions:
-                            if question.startswith('1.') or question.startswith('2.') or question.startswith('3.'):
-                                question = question[3:].strip()  # 去除问题编号和空格
-                                
-                                if question.startswith('"') and question.endswith('"'):
-                                    question = question[1:-1]  # 去除首尾的双引号
-                                elif question.startswith('"'):
-                                    question = question[1:]  # 去除开头的双引号
-                                elif question.endswith('"'):
-                                    question = question[:-1]  # 去除结尾的双引号
-                                
-                                cleaned_questions.append(question)
+                        if question.startswith('"') and question.endswith('"'):
+                            question = question[1:-1]  # 去除首尾的双引号
+                        elif question.startswith('"'):
+                            question = question[1:]  # 去除开头的双引号
+                        elif question.endswith('"'):
+                            question = question[:-1]  # 去除结尾的双引号
                         
-                        logger.trace(f"Related questions: {cleaned_questions}")
-                        return [{"question": question} for question in cleaned_questions[:5]]
+                        cleaned_questions.append(question)
                 
-            except Exception as e:
-                    logger.error(f"Error occurred while sending request to OpenAI model: {str(e)}")
-                    return []
+                logger.trace(f"Related questions: {cleaned_questions}")
+                return [{"question": question} for question in cleaned_questions[:5]]
+        
+    except Exception as e:
+            logger.error(f"Error occurred while sending request to OpenAI model: {str(e)}")
+            return []
+
+
+async def get_related_questions(_app, query, context):
+    """
+    Gets related questions based on the query and context. The context is the
+    snippets of the search results, joined by blank lines.
+    """
+    more_questions_prompt = _more_questions_prompt.format(context=context)
+
+    try:
+        logger.info('Start getting related questions')
+        return await _app.ctx.related_questions_fn(_app, query, more_questions_prompt)
     except Exception as e:
         logger.error(
             f"Encountered error while generating related questions: {str(e)}"
         )
         return []
+# The /query response is a stream of server-sent events:
+#   - contexts: the search results, sent first.
+#   - token: a piece of the llm response.
+#   - related: the related questions, sent as soon as they are ready.
+#   - done: the end of the stream.
+#   - error: the llm failed after the stream started, with the http status
+#     the request would have had, e.g. {"status": 503}.
+# The data of every event is JSON.
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# How many pieces of the llm response can be buffered for a slow client.
+LLM_STREAM_QUEUE_SIZE = 64
+
+# Pieces of the llm response that arrive within LLM_STREAM_COALESCE_WINDOW
+# seconds are sent as one frame, up to LLM_STREAM_COALESCE_SIZE pieces, so
+# that a fast model doesn't cost one write per token.
+LLM_STREAM_COALESCE_SIZE = 8
+LLM_STREAM_COALESCE_WINDOW = 0.02
+
+
+# The frames are built as bytes, orjson output goes to the socket without
+# being decoded to str first.
+_SSE_EVENT_PREFIXES = {
+    event: f"event: {event}\ndata: ".encode()
+    for event in ("contexts", "token", "related", "done", "error")
+}
+
+
+def _sse_event(event: str, data) -> bytes:
+    return _SSE_EVENT_PREFIXES[event] + orjson.dumps(data) + b"\n\n"
+
+
+# Contexts with more text than this are encoded in a thread, so that a big
+# payload (e.g. eight 2000 character SearXNG snippets) doesn't stall the other
+# requests. Smaller ones are cheaper to encode than to hand over to a thread.
+SSE_ENCODE_OFFLOAD_SIZE = 4096
+
+
+def _contexts_size(contexts):
+    return sum(
+        len(value) for c in contexts for value in c.values() if isinstance(value, str)
+    )
+
+
+async def _encode_sse_event(event: str, data) -> bytes:
+    if event == "contexts" and _contexts_size(data) > SSE_ENCODE_OFFLOAD_SIZE:
+        return await asyncio.to_thread(_sse_event, event, data)
+    return _sse_event(event, data)
+
+
+async def _claude_text_stream(stream_manager):
+    """
+    Opens the Claude message stream and yields its text.
+    """
+    async with stream_manager as stream:
+        async for text in stream.text_stream:
+            yield text
+
+
+async def _openai_text_stream(create_request):
+    """
+    Sends the OpenAI chat completion request and yields its text.
+    """
+    async for chunk in await create_request:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+
+_SYSTEM = "system"
+_USER = "user"
+_ASSISTANT = "assistant"
+
+
+def build_messages(system_prompt, chat_history, query):
+    """
+    Builds the chat messages in one list: the system prompt, the chat history
+    and then the user query. Claude takes the system prompt as a separate
+    argument, pass None to leave it out.
+    """
+    user_message = {"role": _USER, "content": query}
+    if system_prompt is None:
+        return [*(chat_history or ()), user_message]
+    return [
+        {"role": _SYSTEM, "content": system_prompt},
+        *(chat_history or ()),
+        user_message,
+    ]
+
+
+def _stream_claude(_app, system_prompt, chat_history, query):
+    """
+    Returns the text stream of the Claude answer to the query.
+    """
+    logger.info("Using Claude for generating LLM response")
+    messages = build_messages(None, chat_history, query)
+    return _claude_text_stream(
+        _app.ctx.llm_client.messages.stream(
+            model=_app.ctx.model,
+            max_tokens=1024,
+            system=system_prompt,
+            messages=messages
+        )
+    )
+
+
+def _stream_openai(_app, system_prompt, chat_history, query):
+    """
+    Returns the text stream of the OpenAI compatible model's answer to the query.
+    """
+    logger.info("Using OpenAI for generating LLM response")
+    if chat_history and len(chat_history) % 2:
+        # 历史记录不是成对的问答时不使用
+        chat_history = None
+    messages = build_messages(system_prompt, chat_history, query)
+    return _openai_text_stream(
+        _app.ctx.llm_client.chat.completions.create(
+            model=_app.ctx.model,
+            messages=messages,
+            max_tokens=1024,
+            stream=True,
+            temperature=0.9,
+        )
+    )
+
+
+async def _read_llm_response(llm_response, queue: asyncio.Queue):
+    """
+    Puts the text of the llm response into the queue, followed by None. If
+    reading fails, the exception is put into the queue instead.
+    """
+    try:
+        async for text in llm_response:
+            await queue.put(text)
+    except Exception as e:
+        await queue.put(e)
+    await queue.put(None)
+
+
+async def _coalesce_llm_response(queue: asyncio.Queue):
+    """
+    Yields the text put into the queue by _read_llm_response, joining the
+    pieces that arrive close together.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        deadline = loop.time() + LLM_STREAM_COALESCE_WINDOW
+        texts = []
+        while True:
+            if item is None:
+                if texts:
+                    yield "".join(texts)
+                return
+            if isinstance(item, Exception):
+                # 先发送已经收到的内容
+                if texts:
+                    yield "".join(texts)
+                raise item
+            texts.append(item)
+            if len(texts) >= LLM_STREAM_COALESCE_SIZE:
+                break
+            if queue.empty():
+                remaining = deadline - loop.time()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                if queue.empty():
+                    break
+            item = queue.get_nowait()
+        yield "".join(texts)
+
+
 async def _raw_stream_response(
-    _app, contexts, llm_response, related_questions_future
-) -> AsyncGenerator[str, None]:
+    contexts, llm_response, related_questions_task
+) -> AsyncGenerator[tuple, None]:
     """
-    A generator that yields the raw stream response. You do not need to call
-    this directly. Instead, use the stream_and_upload_to_kv which will also
-    upload the response to KV.
+    A generator that yields the raw stream response as (event, data) tuples.
+    You do not need to call this directly. Instead, query_function frames the
+    events, sends them and uploads the response to KV.
     """
     # First, yield the contexts.
-    yield json.dumps(contexts)
-    yield "\n\n__LLM_RESPONSE__\n\n"
+    yield "contexts", contexts
     # Second, yield the llm response.
     if not contexts:
         # Prepend a warning to the user
-        yield (
+        yield "token", (
             "(The search engine returned nothing for this query. Please take the"
             " answer with a grain of salt.)\n\n"
         )
-    
-    if "claude-3" in _app.ctx.model.lower():
-        # Process Claude's stream response
-        async for text in llm_response:
-            yield text
-    else:
-        # Process OpenAI's stream response
-        async for chunk in llm_response:
-            if chunk.choices:
-                yield chunk.choices[0].delta.content or ""
-    # Third, yield the related questions. If any error happens, we will just
-    # return an empty list.
-    if related_questions_future is not None:
-        related_questions = await related_questions_future
-        try:
-            result = json.dumps(related_questions)
-        except Exception as e:
-            logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-            result = "[]"
-        yield "\n\n__RELATED_QUESTIONS__\n\n"
-        yield result
+
+    # The llm response is read into a queue by a separate task, so that a slow
+    # client does not hold up reading the upstream stream.
+    queue = asyncio.Queue(maxsize=LLM_STREAM_QUEUE_SIZE)
+    reader = asyncio.create_task(_read_llm_response(llm_response, queue))
+    try:
+        async for text in _coalesce_llm_response(queue):
+            yield "token", text
+            # The related questions run concurrently with the llm response,
+            # send them as soon as they are ready.
+            if related_questions_task is not None and related_questions_task.done():
+                yield "related", await related_questions_task or []
+                related_questions_task = None
+    finally:
+        reader.cancel()
+    # Third, yield the related questions if they were not ready yet. Errors are
+    # handled in get_related_questions, which returns an empty list.
+    if related_questions_task is not None:
+        yield "related", await related_questions_task or []
+    yield "done", None
+
+
+def _is_sse_result(result):
+    # 旧数据不是 dict，或者不是 server-sent events 格式，需要强制刷新
+    return isinstance(result, dict) and result["txt"].startswith("event: ")
+
+
+def _query_hash(query: str):
+    return hashlib.blake2b(query.encode(), digest_size=16).digest()
+
+
+def _is_same_query(result, query: str):
+    # 新数据只存储 query 的哈希，旧数据存储的是完整的 query
+    if "qh" in result:
+        return result["qh"] == _query_hash(query)
+    return result.get("query") == query
+
+
+def _cached_response(result):
+    return sanic.text(
+        result["txt"], content_type="text/event-stream", headers=_SSE_HEADERS
+    )
 
 
 def get_query_object(request):
@@ -762,6 +1331,13 @@ def get_query_object(request):
     return params
 
 
+# Prompt injection markers removed from the query.
+_INST_RE = re.compile(r"\[/?INST\]")
+# The web ui generates the search_uuid with nanoid, uuids also match. The
+# "_history" suffix is reserved for the chat history key of a search_uuid.
+_SEARCH_UUID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}(?<!_history)")
+
+
 @app.route("/query", methods=["POST"])
 async def query_function(request: sanic.Request):
     """
@@ -784,6 +1360,19 @@ async def query_function(request: sanic.Request):
     generate_related_questions = params.get("generate_related_questions", True)
     if not query:
         raise HTTPException("query must be provided.")
+    if not isinstance(query, str):
+        raise InvalidUsage("query must be a string.")
+    try:
+        query_size = len(query.encode())
+    except UnicodeEncodeError:
+        # 例如 JSON 中未配对的代理项 \ud800
+        raise InvalidUsage("query must be valid UTF-8.")
+    if query_size > MAX_QUERY_LEN:
+        raise PayloadTooLarge(f"query must be at most {MAX_QUERY_LEN} bytes.")
+    if search_uuid is not None and not (
+        isinstance(search_uuid, str) and _SEARCH_UUID_RE.fullmatch(search_uuid)
+    ):
+        raise InvalidUsage("search_uuid is invalid.")
     
     # 定义传递给生成答案的聊天历史 以及搜索结果
     chat_history = []
@@ -796,20 +1385,17 @@ async def query_function(request: sanic.Request):
         if _app.ctx.should_do_chat_history:
             # 开启了历史记录，读取历史记录
             history = []
+            result = None
             try:
-                history = await _app.loop.run_in_executor(
-                    _app.ctx.executor, lambda sid: _app.ctx.kv.get(sid), f"{search_uuid}_history"
-                )
-                result = await _app.loop.run_in_executor(
-                    _app.ctx.executor, lambda sid: _app.ctx.kv.get(sid), search_uuid
+                # 历史记录和结果在同一次查询中读取
+                history, result = await _app.ctx.kv.amget(
+                    [f"{search_uuid}_history", search_uuid]
                 )
-                # return sanic.text(result)
-            except KeyError:
-                logger.info(f"Key {search_uuid} not found, will generate again.")
+                history = history or []
+                if result is None:
+                    logger.info(f"Key {search_uuid} not found, will generate again.")
             except Exception as e:
-                logger.error(
-                    f"KV error: {e}\n{traceback.format_exc()}, will generate again."
-                )
+                logger.exception("KV error: {}, will generate again.", e)
             # 如果存在历史记录
             if history:
                 # 获取最后一次记录
@@ -825,20 +1411,18 @@ async def query_function(request: sanic.Request):
                         chat_history = []
                         for entry in history:
                             if "query" in entry and "llm_response" in entry:
-                                chat_history.append({"role": "user", "content": entry["query"]})
-                                chat_history.append({"role": "assistant", "content": entry["llm_response"]})
-                    else:
-                        return sanic.text(result["txt"]) # 查询未改变，直接返回结果
+                                chat_history.append({"role": _USER, "content": entry["query"]})
+                                chat_history.append({"role": _ASSISTANT, "content": entry["llm_response"]})
+                    elif _is_sse_result(result):
+                        return _cached_response(result) # 查询未改变，直接返回结果
         else:
             try:
-                result = await _app.loop.run_in_executor(
-                    _app.ctx.executor, lambda sid: _app.ctx.kv.get(sid), search_uuid
-                )
+                result = await _app.ctx.kv.aget(search_uuid)
                 # debug
-                if isinstance(result, dict):
+                if _is_sse_result(result):
                     # 只有相同的查询才返回同一个结果， 兼容多轮对话。
-                    if result["query"] == query:
-                        return sanic.text(result["txt"])
+                    if _is_same_query(result, query):
+                        return _cached_response(result)
                 else:
                     # TODO: 兼容旧数据代码 之后删除
                     # 旧数据强制刷新
@@ -847,9 +1431,7 @@ async def query_function(request: sanic.Request):
             except KeyError:
                 logger.info(f"Key {search_uuid} not found, will generate again.")
             except Exception as e:
-                logger.error(
-                    f"KV error: {e}\n{traceback.format_exc()}, will generate again."
-                )
+                logger.exception("KV error: {}, will generate again.", e)
     else:
         raise HTTPException("search_uuid must be provided.")
 
@@ -865,130 +1447,91 @@ async def query_function(request: sanic.Request):
     # First, do a search query.
     # query = query or _default_query
     # Basic attack protection: remove "[INST]" or "[/INST]" from the query
-    query = re.sub(r"\[/?INST\]", "", query)
+    if "[" in query:
+        query = _INST_RE.sub("", query)
     # 开启聊天历史并且有有效数据 则不再重新请求搜索
     if not _app.ctx.should_do_chat_history or  contexts in ("", None):
-        contexts = await _app.loop.run_in_executor(
-            _app.ctx.executor, _app.ctx.search_function, query
-        )
+        contexts = None
+        try:
+            contexts = await _app.ctx.kv.asearch_cache_get(_app.ctx.backend, query)
+        except Exception as e:
+            logger.error(f"KV error: {e}, will search again.")
+        if contexts is None:
+            contexts = await _app.ctx.search_function(query)
+            if contexts:
+                submit_kv_write(
+                    _app, _app.ctx.kv.asearch_cache_put, _app.ctx.backend, query, contexts
+                )
+        else:
+            logger.info(f"Search cache hit for query: {query}")
 
-    system_prompt = _rag_query_text.format(
+    system_prompt = _RAG_FORMAT(
         context="\n\n".join(
-            [f"[[citation:{i+1}]] {c['snippet']}" for i, c in enumerate(contexts)]
+            map(_CITATION_FORMAT, itertools.count(1), (c["snippet"] for c in contexts))
         )
     )
+    related_questions_task = None
+    response = None
     try:
-        if _app.ctx.should_do_related_questions and generate_related_questions:
-            # While the answer is being generated, we can start generating
-            # related questions as a future.
-            related_questions_future = get_related_questions(_app, query, contexts)
-        if "claude-3" in _app.ctx.model.lower():
-            logger.info("Using Claude for generating LLM response")
-            client = new_async_client(_app)
-            messages=[
-                {"role": "user", "content": query},
-            ]
-            messages = []
-            if chat_history:
-                messages.extend(chat_history)  # 将历史记录添加到列表开头
-            # 然后添加当前查询消息
-            messages.append({"role": "user", "content": query})
-            response = await request.respond(content_type="text/html")
-            all_yielded_results = []
-
-            # First, yield the contexts.
-            logger.info("Sending initial context and LLM response marker.")
-            context_str = json.dumps(contexts)
-            await response.send(context_str)
-            all_yielded_results.append(context_str)
-            await response.send("\n\n__LLM_RESPONSE__\n\n")
-            all_yielded_results.append("\n\n__LLM_RESPONSE__\n\n")
-
-            # Second, yield the llm response.
-            if not contexts:
-                warning = "(The search engine returned nothing for this query. Please take the answer with a grain of salt.)\n\n"
-                await response.send(warning)
-                all_yielded_results.append(warning)
-            if related_questions_future is not None:
-                related_questions_task = asyncio.create_task(related_questions_future)
-            async with client.messages.stream(
-                model=_app.ctx.model,
-                max_tokens=1024,
-                system=system_prompt,
-                messages=messages
-            )as stream:
-                async for text in stream.text_stream:
-                    all_yielded_results.append(text)
-                    await response.send(text)
-
-            logger.info("Finished streaming LLM response")
-            # 在生成回复的同时异步等待相关问题任务完成
-            if related_questions_future is not None:
-                try:
-                    logger.info("About to send related questions.")
-                    related_questions = await related_questions_task
-                    logger.info("Related questions sent.")
-                    result = json.dumps(related_questions)
-                    await response.send("\n\n__RELATED_QUESTIONS__\n\n")
-                    all_yielded_results.append("\n\n__RELATED_QUESTIONS__\n\n")
-                    await response.send(result)
-                    all_yielded_results.append(result)
-                except Exception as e:
-                    logger.error(f"Error during related questions generation: {e}")
-            
-        else:
-            logger.info("Using OpenAI for generating LLM response")
-            openai_client = new_async_client(_app)
-            messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query},
-                ]
-
-            if chat_history and len(chat_history) % 2 == 0:
-                # 将历史插入到消息中 index = 1 的位置
-                messages[1:1] = chat_history
-            llm_response = await openai_client.chat.completions.create(
-                model=_app.ctx.model,
-                messages=messages,
-                max_tokens=1024,
-                stream=True,
-                temperature=0.9,
+        if _app.ctx.should_do_related_questions and generate_related_questions and contexts:
+            # Start generating related questions right away, so that the
+            # request runs concurrently with the llm response request below.
+            # Without search results there is nothing to base them on.
+            related_questions_task = asyncio.create_task(
+                get_related_questions(
+                    _app, query, "\n\n".join(c["snippet"] for c in contexts)
+                )
             )
-            response = await request.respond(content_type="text/html")
-            # First, stream and yield the results.
-            all_yielded_results = []
-            async for result in _raw_stream_response(
-                _app, contexts, llm_response, related_questions_future
-            ):
-                all_yielded_results.append(result)
-                await response.send(result)
-            logger.info("Finished streaming LLM response")            
+        # The stream is only opened once the contexts have been sent, so the
+        # client sees the sources while the llm starts up.
+        llm_response = _app.ctx.llm_stream_fn(_app, system_prompt, chat_history, query)
+        response = await request.respond(
+            content_type="text/event-stream", headers=_SSE_HEADERS
+        )
+        # First, stream and yield the results. The llm response and the
+        # related questions are kept as well, to be stored in the chat history.
+        all_yielded_results = io.BytesIO()
+        llm_buf = io.StringIO()
+        related_questions = None
+        async for event, data in _raw_stream_response(
+            contexts, llm_response, related_questions_task
+        ):
+            if event == "token":
+                llm_buf.write(data)
+            elif event == "related":
+                related_questions = data
+            result = await _encode_sse_event(event, data)
+            all_yielded_results.write(result)
+            await response.send(result)
+        logger.info("Finished streaming LLM response")
 
     except Exception as e:
-        logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-        return sanic.json({"message": "Internal server error."}, 503)
+        logger.exception("encountered error: {}", e)
+        if related_questions_task is not None:
+            related_questions_task.cancel()
+        status = 429 if getattr(e, "status_code", None) == 429 else 503
+        if response is not None:
+            # 响应已经开始发送，无法再返回错误状态码，通过 error 事件告知客户端
+            await response.send(_sse_event("error", {"status": status}))
+            await response.eof()
+            return
+        return sanic.json({"message": "Internal server error."}, status)
     # Second, upload to KV. Note that if uploading to KV fails, we will silently
     # ignore it, because we don't want to affect the user experience.
     await response.eof()
+    # 原来的缓存是直接根据sid返回结果，开启聊天历史后 同一个sid存储多轮对话，因此需要存储 query（的哈希）兼容多轮对话
+    record = {"qh": _query_hash(query), "txt": all_yielded_results.getvalue().decode()}
     if _app.ctx.should_do_chat_history:
-        # 保存聊天历史
-        _search_results, _llm_response, _related_questions = await _app.loop.run_in_executor(
-            _app.ctx.executor, extract_all_sections, "".join(all_yielded_results)
-        )
-        if _search_results:
-            _search_results = json.loads(_search_results)
-        if _related_questions:
-            _related_questions = json.loads(_related_questions)
-        _ = _app.ctx.executor.submit(
-            _app.ctx.kv.append, f"{search_uuid}_history", {
+        # 保存聊天历史，和结果在同一次写入中完成
+        submit_kv_write(
+            _app, _app.ctx.kv.aput_and_append, search_uuid, record, f"{search_uuid}_history", {
                 "query": query,
-                "search_results": _search_results,
-                "llm_response": _llm_response,
-                "related_questions": _related_questions
+                "search_results": contexts,
+                "llm_response": llm_buf.getvalue().strip(),
+                "related_questions": related_questions
             })
-    _ = _app.ctx.executor.submit(
-        _app.ctx.kv.put, search_uuid, {"query": query, "txt": "".join(all_yielded_results)}  # 原来的缓存是直接根据sid返回结果，开启聊天历史后 同一个sid存储多轮对话，因此需要存储 query 兼容多轮对话
-    )
+    else:
+        submit_kv_write(_app, _app.ctx.kv.aput, search_uuid, record)
 
 
 app.static("/ui", os.path.join(BASE_DIR, "ui/"), name="/")
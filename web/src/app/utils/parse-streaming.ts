@@ -2,8 +2,20 @@ import { Relate } from "@/app/interfaces/relate";
 import { Source } from "@/app/interfaces/source";
 import { fetchStream } from "@/app/utils/fetch-stream";
 
-const LLM_SPLIT = "__LLM_RESPONSE__";
-const RELATED_SPLIT = "__RELATED_QUESTIONS__";
+const EVENT_SPLIT = "\n\n";
+
+const parseEvent = (raw: string) => {
+  let event = "message";
+  const data: string[] = [];
+  raw.split("\n").forEach((line) => {
+    if (line.startsWith("event:")) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith("data:")) {
+      data.push(line.slice(5).trimStart());
+    }
+  });
+  return { event, data: data.join("\n") };
+};
 
 export const parseStreaming = async (
   controller: AbortController,
@@ -16,9 +28,10 @@ export const parseStreaming = async (
   onError?: (status: number) => void,
 ) => {
   const decoder = new TextDecoder();
-  let uint8Array = new Uint8Array();
-  let chunks = "";
-  let sourcesEmitted = false;
+  let buffer = "";
+  let markdown = "";
+  let relatesEmitted = false;
+  let errored = false;
   const response = await fetch(`/query`, {
     method: "POST",
     headers: {
@@ -45,34 +58,50 @@ export const parseStreaming = async (
         .replace(/\[[cC]itation:(\d+)]/g, "[citation]($1)"),
     );
   };
+  const onEvent = ({ event, data }: { event: string; data: string }) => {
+    switch (event) {
+      case "contexts":
+        try {
+          onSources(JSON.parse(data));
+        } catch (e) {
+          onSources([]);
+        }
+        break;
+      case "token":
+        markdown += JSON.parse(data);
+        markdownParse(markdown);
+        break;
+      case "related":
+        relatesEmitted = true;
+        try {
+          onRelates(JSON.parse(data));
+        } catch (e) {
+          onRelates([]);
+        }
+        break;
+      case "error":
+        errored = true;
+        try {
+          onError?.(JSON.parse(data).status);
+        } catch (e) {
+          onError?.(500);
+        }
+        break;
+    }
+  };
   fetchStream(
     response,
     (chunk) => {
-      uint8Array = new Uint8Array([...uint8Array, ...chunk]);
-      chunks = decoder.decode(uint8Array, { stream: true });
-      if (chunks.includes(LLM_SPLIT)) {
-        const [sources, rest] = chunks.split(LLM_SPLIT);
-        if (!sourcesEmitted) {
-          try {
-            onSources(JSON.parse(sources));
-          } catch (e) {
-            onSources([]);
-          }
-        }
-        sourcesEmitted = true;
-        if (rest.includes(RELATED_SPLIT)) {
-          const [md] = rest.split(RELATED_SPLIT);
-          markdownParse(md);
-        } else {
-          markdownParse(rest);
-        }
+      buffer += decoder.decode(chunk, { stream: true });
+      let index = buffer.indexOf(EVENT_SPLIT);
+      while (index !== -1) {
+        onEvent(parseEvent(buffer.slice(0, index)));
+        buffer = buffer.slice(index + EVENT_SPLIT.length);
+        index = buffer.indexOf(EVENT_SPLIT);
       }
     },
     () => {
-      const [_, relates] = chunks.split(RELATED_SPLIT);
-      try {
-        onRelates(JSON.parse(relates));
-      } catch (e) {
+      if (!relatesEmitted && !errored) {
         onRelates([]);
       }
     },